@@ -1,6 +1,15 @@
+import base64
+import concurrent.futures
+import json
 import logging
+import multiprocessing
 import os
+import shutil
+import tempfile
+import urllib.parse
+import zlib
 
+import numpy as np
 import vtk
 import ctk
 import qt
@@ -9,7 +18,11 @@ from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 
 from Utils import BusyCursor
+from Utils import CohortStatistics
 from Utils import DependencyInstaller
+from Utils import DICOMIndex
+from Utils import DICOMPipeline
+from Utils import LazySeries
 from dicomweb_client.api import DICOMwebClient
 import pydicom
 from DICOMLib import DICOMUtils
@@ -134,6 +147,7 @@ class FHIRReaderWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.observations_table_node = None
         self.loaded_id = None
         self.loaded_dicom = {}
+        self.dicomIndexTimer = None
 
     def setup(self):
         """
@@ -163,6 +177,23 @@ class FHIRReaderWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         # These connections ensure that we update parameter node when scene is closed
         self.addObserver(slicer.mrmlScene, slicer.mrmlScene.StartCloseEvent, self.onSceneStartClose)
         self.addObserver(slicer.mrmlScene, slicer.mrmlScene.EndCloseEvent, self.onSceneEndClose)
+        # These connections store the fetched resources with the scene and restore them when the scene is loaded
+        self.addObserver(slicer.mrmlScene, slicer.mrmlScene.StartSaveEvent, self.onSceneStartSave)
+        self.addObserver(slicer.mrmlScene, slicer.mrmlScene.EndImportEvent, self.onSceneEndImport)
+
+        cohortCollapsible = ctk.ctkCollapsibleButton()
+        cohortCollapsible.text = "Cohort Observations"
+        self.layout.addWidget(cohortCollapsible)
+        cohortLayout = qt.QFormLayout(cohortCollapsible)
+        cohortCollapsible.collapsed = True
+
+        self.cohortCodeLineEdit = qt.QLineEdit()
+        self.cohortCodeLineEdit.placeholderText = "http://loinc.org|4548-4"
+        self.cohortCodeLineEdit.toolTip = "Observation code to aggregate over all loaded patients, as system|code."
+        cohortLayout.addRow("Observation Code", self.cohortCodeLineEdit)
+        self.cohortButton = qt.QPushButton("Compute Cohort Statistics")
+        self.cohortButton.connect('clicked(bool)', self.onCohortButton)
+        cohortLayout.addRow(self.cohortButton)
 
         advancedCollapsible = ctk.ctkCollapsibleButton()
         advancedCollapsible.text = "Advanced"
@@ -178,10 +209,23 @@ class FHIRReaderWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         add_install_button("fhirclient", DependencyInstaller.check_and_install_fhirclient)
 
+        rebuildIndexButton = qt.QPushButton("Rebuild DICOM index")
+        rebuildIndexButton.toolTip = "Re-sweep all studies of the DICOMweb server, for example after study dates were corrected."
+        rebuildIndexButton.connect('clicked(bool)', self.onRebuildDICOMIndexButton)
+        advancedLayout.addRow(rebuildIndexButton)
+
+        self.lazyLoadingCheckBox = qt.QCheckBox()
+        self.lazyLoadingCheckBox.checked = self.logic.lazyLoading
+        self.lazyLoadingCheckBox.toolTip = ("Series with at least {0} frames are shown as soon as their geometry is known "
+            "and their frames are retrieved around the current slice first.".format(self.logic.lazyLoadingFrameThreshold))
+        self.lazyLoadingCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
+        advancedLayout.addRow("Lazy loading of large series", self.lazyLoadingCheckBox)
+
         # These connections ensure that whenever user changes some settings on the GUI, that is saved in the MRML scene
         # (in the selected parameter node).
-        self.ui.FhirServerLineEdit.connect("valueChanged(str)", self.updateParameterNodeFromGUI)
-        self.ui.DICOMLineEdit.connect("valueChanged(str)", self.updateParameterNodeFromGUI)
+        self.ui.FhirServerLineEdit.connect("textChanged(QString)", self.updateParameterNodeFromGUI)
+        self.ui.DICOMLineEdit.connect("textChanged(QString)", self.updateParameterNodeFromGUI)
+        self.cohortCodeLineEdit.connect("textChanged(QString)", self.updateParameterNodeFromGUI)
         self.ui.PatientListWidget.itemDoubleClicked.connect(self.onPatientListWidgetDoubleClicked)
         self.ui.ObservationListWidget.itemDoubleClicked.connect(self.onObservationListWidgetDoubleClicked)
         self.ui.DICOMTreeWidget.itemDoubleClicked.connect(self.onDICOMTreeWidgetDoubleClicked)
@@ -189,15 +233,14 @@ class FHIRReaderWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         # Buttons
         self.ui.loadPatientsButton.connect('clicked(bool)', self.onLoadPatientsButton)
 
+        # Polls the background DICOM index refresh so the patient list can be flagged when it finishes
+        self.dicomIndexTimer = qt.QTimer()
+        self.dicomIndexTimer.setInterval(1000)
+        self.dicomIndexTimer.connect('timeout()', self.onDICOMIndexTimer)
+
         # Make sure parameter node is initialized (needed for module reload)
         self.initializeParameterNode()
 
-        self.patient_table_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode")
-        self.patient_table_node.SetName("PatientInfo_TableNode")
-
-        self.observation_table_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode")
-        self.observation_table_node.SetName("ObservationInfo_TableNode")
-
         with open(self.resourcePath('fhir-layout.xml')) as fh:
             layout_text = fh.read()
 
@@ -215,18 +258,33 @@ class FHIRReaderWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             tableWidget = layoutManager.tableWidget(i)
             tableController = tableWidget.tableController()
             tableController.pinButton().hide()
-            
+
+        self.setupTableNodes()
+
+    def setupTableNodes(self):
+        """
+        Find or create the patient and observation table nodes and show them in the table views.
+        Table nodes saved with a scene are reused when that scene is loaded.
+        """
+        self.patient_table_node = self.logic._getOrCreateNode("vtkMRMLTableNode", "PatientInfo_TableNode")
+        self.observation_table_node = self.logic._getOrCreateNode("vtkMRMLTableNode", "ObservationInfo_TableNode")
+
+        layoutManager = slicer.app.layoutManager()
+        for i in range(layoutManager.tableViewCount):
+            tableWidget = layoutManager.tableWidget(i)
             if tableWidget.name == 'qMRMLTableWidgetPatientInformation':
-                layoutManager.tableWidget(i).tableView().mrmlTableViewNode().SetTableNodeID(self.patient_table_node.GetID())
-                print(layoutManager.tableWidget(1).tableView().mrmlTableViewNode().GetTableNodeID())
+                tableWidget.tableView().mrmlTableViewNode().SetTableNodeID(self.patient_table_node.GetID())
             elif tableWidget.name == 'qMRMLTableWidgetPatientObservations':
-                layoutManager.tableWidget(i).tableView().mrmlTableViewNode().SetTableNodeID(self.observation_table_node.GetID())
+                tableWidget.tableView().mrmlTableViewNode().SetTableNodeID(self.observation_table_node.GetID())
 
     def cleanup(self):
         """
         Called when the application closes and the module widget is destroyed.
         """
         self.removeObservers()
+        if self.dicomIndexTimer is not None:
+            self.dicomIndexTimer.stop()
+        self.logic.cleanup()
 
     def enter(self):
         """
@@ -271,6 +329,38 @@ class FHIRReaderWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         if self.parent.isEntered:
             self.initializeParameterNode()
 
+    def onSceneStartSave(self, caller, event):
+        """
+        Called just before the scene is saved.
+        """
+        if self._parameterNode is not None:
+            self.logic.saveSession(self._parameterNode, self.loaded_dicom, self.loaded_id)
+
+    def onSceneEndImport(self, caller, event):
+        """
+        Called after a scene is loaded. Restores the fetched resources saved with the scene without contacting the servers.
+        """
+        self.initializeParameterNode()
+        session = self.logic.restoreSession(self._parameterNode)
+        if session is None:
+            return
+        loadedDICOM, loadedID = session
+
+        self.setupTableNodes()
+        self.loaded_id = None
+        self.loadPatients()
+        selectedPatient = int(self._parameterNode.GetParameter("SelectedPatient"))
+        if 0 <= selectedPatient < len(self.logic.patients):
+            self.ui.PatientListWidget.setCurrentRow(selectedPatient)
+            self.loadPatientInfo(selectedPatient)
+            self.updateObservationList()
+            self.updateDICOMTree()
+            observationType = self._parameterNode.GetParameter("SelectedObservationType")
+            if observationType in self.logic.selectedObservations:
+                self.showObservations(observationType)
+        self.loaded_dicom = loadedDICOM
+        self.loaded_id = loadedID
+
     def initializeParameterNode(self):
         """
         Ensure parameter node exists and observed.
@@ -315,6 +405,13 @@ class FHIRReaderWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self._updatingGUIFromParameterNode = True
 
         # Update node selectors and sliders
+        # Only assign changed text, setting it moves the cursor to the end while the user is typing
+        for lineEdit, parameterName in ((self.ui.FhirServerLineEdit, "FhirServerURL"), (self.ui.DICOMLineEdit, "DICOMServerURL"),
+                (self.cohortCodeLineEdit, "CohortCode")):
+            if (lineEdit.text != self._parameterNode.GetParameter(parameterName)):
+                lineEdit.text = self._parameterNode.GetParameter(parameterName)
+        self.lazyLoadingCheckBox.checked = self._parameterNode.GetParameter("LazyLoading") == "true"
+        self.logic.lazyLoading = self.lazyLoadingCheckBox.checked
         self.ui.loadPatientsButton.enabled = allowLoading
 
         # All the GUI updates are done
@@ -331,6 +428,11 @@ class FHIRReaderWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         wasModified = self._parameterNode.StartModify()  # Modify all properties in a single batch
 
+        self._parameterNode.SetParameter("FhirServerURL", self.ui.FhirServerLineEdit.text)
+        self._parameterNode.SetParameter("DICOMServerURL", self.ui.DICOMLineEdit.text)
+        self._parameterNode.SetParameter("CohortCode", self.cohortCodeLineEdit.text)
+        self._parameterNode.SetParameter("LazyLoading", "true" if self.lazyLoadingCheckBox.checked else "false")
+
         self._parameterNode.EndModify(wasModified)
 
     def clearUI(self):
@@ -356,7 +458,37 @@ class FHIRReaderWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             if (len(self.ui.DICOMLineEdit.text)):
                 self.ui.DICOMStatusLabel.text = 'Connected'
             self.logic.fetchPatients()
+            self._parameterNode.SetParameter("SelectedPatient", "-1")
             self.loadPatients()
+            if (self.logic.dicomIndex is not None):
+                self.dicomIndexTimer.start()
+
+    def onRebuildDICOMIndexButton(self):
+        if (self.logic.dicomClient is None):
+            slicer.util.errorDisplay('Connect to a DICOMweb server first.', windowTitle='Error')
+            return
+        self.logic.startDICOMIndexRefresh(full=True)
+        self.dicomIndexTimer.start()
+
+    def onDICOMIndexTimer(self):
+        if (self.logic.dicomIndex.isBuilding):
+            return
+        self.dicomIndexTimer.stop()
+        if (self.logic.dicomIndex.lastError is not None):
+            logging.warning('DICOM index refresh failed: {0}'.format(self.logic.dicomIndex.lastError))
+        self.updatePatientImagingFlags()
+
+    def updatePatientImagingFlags(self):
+        """
+        Show in bold the patients that the DICOM index reports as having imaging.
+        """
+        for row in range(self.ui.PatientListWidget.count):
+            item = self.ui.PatientListWidget.item(row)
+            hasImaging = self.logic.patientHasImaging(item.data(21)[1])
+            font = item.font()
+            font.setBold(hasImaging)
+            item.setFont(font)
+            item.setToolTip('Has DICOM studies' if hasImaging else '')
 
     def loadPatients(self):
         self.clearUI()
@@ -370,8 +502,11 @@ class FHIRReaderWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             else:
                 item.setText('Patient {0}'.format(patient.id))
             self.ui.PatientListWidget.addItem(item)
+        self.updatePatientImagingFlags()
 
     def onPatientListWidgetDoubleClicked(self, item):
+        self._parameterNode.SetParameter("SelectedPatient", str(item.data(21)[0]))
+        self._parameterNode.SetParameter("SelectedObservationType", "")
         with BusyCursor.BusyCursor():
             self.observation_table_node.RemoveAllColumns()
             self.loadPatientInfo(item.data(21)[0])
@@ -381,17 +516,44 @@ class FHIRReaderWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                 self.loaded_id = item.data(21)[1]
 
     def loadPatientObservations(self, idx):
-        self.ui.ObservationListWidget.clear()
         patient = self.logic.patients[idx]
         self.logic.getObservations(patient)
+        self.updateObservationList()
+
+    def updateObservationList(self):
+        self.ui.ObservationListWidget.clear()
         for observationType in list(self.logic.selectedObservations.keys())[1:]:
             item = qt.QListWidgetItem()
             item.setData(21, observationType)
             item.setText('{0}'.format(observationType))
             self.ui.ObservationListWidget.addItem(item)
 
+    def showTableInObservationView(self, tableNode):
+        layoutManager = slicer.app.layoutManager()
+        for i in range(layoutManager.tableViewCount):
+            tableWidget = layoutManager.tableWidget(i)
+            if tableWidget.name == 'qMRMLTableWidgetPatientObservations':
+                tableWidget.tableView().mrmlTableViewNode().SetTableNodeID(tableNode.GetID())
+
+    def onCohortButton(self):
+        code = self.cohortCodeLineEdit.text.strip()
+        if (len(code) == 0 or len(self.logic.patients) == 0):
+            slicer.util.errorDisplay('Load patients and enter an observation code first.', windowTitle='Error')
+            return
+        with BusyCursor.BusyCursor():
+            self.logic.getCohortObservations(code)
+            if (self.logic.cohortObservations is None):
+                return
+            summaryTableNode = self.logic.computeCohortSummary()
+        self.showTableInObservationView(summaryTableNode)
+
     def onObservationListWidgetDoubleClicked(self, item):
         observationType = item.data(21)
+        self._parameterNode.SetParameter("SelectedObservationType", observationType)
+        self.showObservations(observationType)
+
+    def showObservations(self, observationType):
+        self.showTableInObservationView(self.observation_table_node)
         self.observation_table_node.SetLocked(False)
         self.observation_table_node.RemoveAllColumns()        
 
@@ -427,7 +589,7 @@ class FHIRReaderWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
             self.observation_table_node.AddColumn(columnArray)
 
-        observation_table_node.SetLocked(True);
+        self.observation_table_node.SetLocked(True)
 
     def loadPatientInfo(self, idx):
         self.patient_table_node.SetLocked(False)
@@ -465,6 +627,10 @@ class FHIRReaderWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             self.loaded_dicom = {}
 
         self.logic.fetchStudiesAndSeries(patientID)
+        self.updateDICOMTree()
+
+    def updateDICOMTree(self):
+        self.ui.DICOMTreeWidget.clear()
         for study in self.logic.selectedDICOM:
             studyItem = qt.QTreeWidgetItem()
             studyItem.setText(0, study['displayName'])
@@ -483,11 +649,21 @@ class FHIRReaderWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             node = slicer.util.getNode(self.loaded_dicom[(studyUID, serieUID)])
             slicer.util.setSliceViewerLayers(background = node)
         else:
-            self.logic.fetchInstances(studyUID, serieUID)
-            with DICOMUtils.TemporaryDICOMDatabase() as db:
-                DICOMUtils.importDicom(os.getcwd()+'/temp', db)
-                nodeID = DICOMUtils.loadSeriesByUID([serieUID])[0]
+            nodeID = self.logic.loadSeriesLazily(studyUID, serieUID) if self.logic.lazyLoading else None
+            if (nodeID is not None):
+                self.loaded_dicom[(studyUID, serieUID)] = nodeID
+                slicer.util.setSliceViewerLayers(background = nodeID, fit = True)
+                return
+
+            nodeID = self.logic.fetchAndLoadSeries(studyUID, serieUID)
+            if (nodeID is not None):
                 self.loaded_dicom[(studyUID, serieUID)] = nodeID
+                slicer.util.setSliceViewerLayers(background = nodeID, fit = True)
+            else:
+                with DICOMUtils.TemporaryDICOMDatabase() as db:
+                    DICOMUtils.importDicom(os.getcwd()+'/temp', db)
+                    nodeID = DICOMUtils.loadSeriesByUID([serieUID])[0]
+                    self.loaded_dicom[(studyUID, serieUID)] = nodeID
 
             for f in os.listdir(os.getcwd()+'/temp'):
                 os.remove(os.path.join(os.getcwd()+'/temp', f))
@@ -524,11 +700,112 @@ class FHIRReaderLogic(ScriptedLoadableModuleLogic):
 
         self.fhirClient = None
         self.dicomClient = None    
+        self.dicomIndex = None
+
+        # Series with at least this many frames are retrieved frame by frame on demand
+        self.lazyLoading = True
+        self.lazyLoadingFrameThreshold = 500
+        self.lazyVolumes = {}
+
+        self.cohortObservations = None
+
+        # Parses and decodes retrieved instances while the rest of the series is downloaded
+        self.parseExecutor = None
+
+    def cleanup(self):
+        """
+        Stop retrieving frames of lazily loaded volumes and shut down the parse pool.
+        """
+        for lazyVolume in self.lazyVolumes.values():
+            lazyVolume.stop()
+        self.lazyVolumes = {}
+        if (self.parseExecutor is not None):
+            self.parseExecutor.shutdown(wait=False, cancel_futures=True)
+            self.parseExecutor = None
 
     def setDefaultParameters(self, parameterNode):
         """
         Initialize parameter node with default settings.
         """
+        if not parameterNode.GetParameter("FhirServerURL"):
+            parameterNode.SetParameter("FhirServerURL", "")
+        if not parameterNode.GetParameter("DICOMServerURL"):
+            parameterNode.SetParameter("DICOMServerURL", "")
+        if not parameterNode.GetParameter("CohortCode"):
+            parameterNode.SetParameter("CohortCode", "")
+        if not parameterNode.GetParameter("LazyLoading"):
+            parameterNode.SetParameter("LazyLoading", "true")
+        if not parameterNode.GetParameter("SelectedPatient"):
+            parameterNode.SetParameter("SelectedPatient", "-1")
+
+    def saveSession(self, parameterNode, loadedDICOM, loadedPatientID):
+        """
+        Store the fetched resources in a compressed text node referenced by the parameter node, so that it is
+        written as a separate file of the scene bundle. Loaded volumes are referenced from the parameter node
+        so that their IDs are kept up to date when the scene is loaded.
+        Lazily loaded volumes whose frames are not all retrieved yet are left out, so that they are loaded
+        again instead of being restored with missing frames.
+        """
+        loadedDICOM = {key: nodeID for key, nodeID in loadedDICOM.items()
+            if nodeID not in self.lazyVolumes or self.lazyVolumes[nodeID].isComplete}
+        state = {
+            'fhirURL': self.fhirURL,
+            'dicomURL': self.dicomURL,
+            'patients': [patient.as_json() for patient in self.patients],
+            'observations': [observation.as_json() for observation in self.selectedObservations.get('all', [])],
+            'selectedDICOM': self.selectedDICOM,
+            'loadedPatientID': loadedPatientID,
+            'loadedSeries': [list(key) for key in loadedDICOM],
+        }
+        encoded = base64.b64encode(zlib.compress(json.dumps(state, separators=(',', ':')).encode('utf-8'), 9))
+
+        textNode = parameterNode.GetNodeReference("SessionState")
+        if textNode is None:
+            textNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTextNode", "FHIRReaderSession")
+            textNode.SetForceCreateStorageNode(slicer.vtkMRMLTextNode.CreateStorageNodeAlways)
+            parameterNode.SetNodeReferenceID("SessionState", textNode.GetID())
+        textNode.SetText(encoded.decode('ascii'))
+
+        parameterNode.RemoveNodeReferenceIDs("LoadedVolume")
+        for index, nodeID in enumerate(loadedDICOM.values()):
+            parameterNode.SetNthNodeReferenceID("LoadedVolume", index, nodeID)
+
+    def restoreSession(self, parameterNode):
+        """
+        Restore the resources stored by saveSession. Returns the loaded series (as in FHIRReaderWidget.loaded_dicom)
+        and the loaded patient ID, or None if the parameter node has no saved session.
+        """
+        textNode = parameterNode.GetNodeReference("SessionState")
+        if textNode is None or not textNode.GetText():
+            return None
+        try:
+            state = json.loads(zlib.decompress(base64.b64decode(textNode.GetText())).decode('utf-8'))
+        except (ValueError, zlib.error) as e:
+            logging.warning('Saved FHIRReader session could not be read: {0}'.format(e))
+            return None
+
+        self.fhirURL = state['fhirURL']
+        self.dicomURL = state['dicomURL']
+        # Clients do not contact the servers when created, so the next network action uses the restored URLs
+        if (self.fhirURL):
+            settings = {
+                'app_id': 'my_web_app',
+                'api_base': self.fhirURL + "fhir/"
+            }
+            self.smart = client.FHIRClient(settings=settings)
+        if (self.dicomURL):
+            self.dicomClient = DICOMwebClient(url=self.dicomURL)
+            self.openDICOMIndex()
+        self.patients = [p.Patient(patient, strict=False) for patient in state['patients']]
+        self.setObservations([o.Observation(observation, strict=False) for observation in state['observations']])
+        self.selectedDICOM = state['selectedDICOM']
+
+        loadedDICOM = {}
+        for index, (studyUID, seriesUID) in enumerate(state['loadedSeries']):
+            volumeNode = parameterNode.GetNthNodeReference("LoadedVolume", index)
+            if volumeNode is not None:
+                loadedDICOM[(studyUID, seriesUID)] = volumeNode.GetID()
+        return loadedDICOM, state['loadedPatientID']
 
     def testConnection(self, fhirUrl, dicomUrl):
         fhirError = False
@@ -564,6 +841,9 @@ class FHIRReaderLogic(ScriptedLoadableModuleLogic):
             except BaseException as e: 
                 dicomError = True
                 slicer.util.errorDisplay('Error occured while communicating with DICOM Server. Does te server exist at {0} ?'.format(self.dicomURL), windowTitle='Error')
+
+            if (not dicomError):
+                self.startDICOMIndexRefresh()
                 
 
         return dicomError or fhirError
@@ -608,18 +888,177 @@ class FHIRReaderLogic(ScriptedLoadableModuleLogic):
 
     def getObservations(self, patient):
         search = o.Observation.where(struct={'subject': str(patient.id), '_count': '200'})
+        self.setObservations(self.performSearch(search))
+
+    def setObservations(self, observations):
         self.selectedObservations = {}
-        self.selectedObservations['all'] = self.performSearch(search)
+        self.selectedObservations['all'] = observations
         for observation in self.selectedObservations['all']:
             observationType = observation.code.coding[0].display
             if (observationType not in self.selectedObservations):
                 self.selectedObservations[observationType] = []
             self.selectedObservations[observationType].append(observation)       
 
+    def getCohortObservations(self, code, patients=None, batchSize=50, workerCount=8):
+        """
+        Search the Observations with the given code (for example "http://loinc.org|4548-4") of a set of
+        patients, defaulting to all loaded patients. Patients are split into batches searched in parallel and
+        the results are stored as NumPy arrays in self.cohortObservations, with values converted to a common
+        UCUM unit.
+        """
+        patients = self.patients if patients is None else patients
+        patientIDs = [str(patient.id) for patient in patients]
+        batches = [patientIDs[i:i + batchSize] for i in range(0, len(patientIDs), batchSize)]
+        columns = ([], [], [], [])
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workerCount) as executor:
+                for batchColumns in executor.map(lambda batch: self._searchCohortBatch(code, batch), batches):
+                    for column, batchColumn in zip(columns, batchColumns):
+                        column.extend(batchColumn)
+        except BaseException as e:
+            self.cohortObservations = None
+            slicer.util.errorDisplay('Error occurred while communicating with FHIR Server.', windowTitle='Error')
+            return
+
+        subjects, values, units, dates = columns
+        values, unit, keep = CohortStatistics.normalizeUnits(values, units, CohortStatistics.knownConversions.get(code))
+        self.cohortObservations = {
+            'code': code,
+            'unit': unit,
+            'patients': np.array(subjects, dtype=object)[keep],
+            'values': values[keep],
+            'dates': np.array(dates, dtype='datetime64[s]')[keep],
+            'discarded': int(np.count_nonzero(~keep)),
+        }
+
+    def _searchCohortBatch(self, code, patientIDs):
+        """
+        Return the subject, value, unit and date columns of the Observations of a batch of patients.
+        Raw JSON is used instead of fhirclient models, which are too slow to build for large cohorts.
+        """
+        # One client per batch, batches are searched in parallel threads
+        server = client.FHIRClient(settings={'app_id': 'my_web_app', 'api_base': self.fhirURL + "fhir/"}).server
+        pageServer = client.FHIRClient(settings={'app_id': 'my_web_app', 'api_base': self.fhirURL}).server
+        query = urllib.parse.urlencode({
+            'code': code,
+            'subject': ','.join('Patient/' + patientID for patientID in patientIDs),
+            '_elements': 'subject,value,effective',
+            '_count': '1000'})
+        bundle = server.request_json('Observation?' + query)
+        subjects, values, units, dates = [], [], [], []
+        while True:
+            for entry in bundle.get('entry', []):
+                resource = entry['resource']
+                quantity = resource.get('valueQuantity')
+                if (quantity is None or quantity.get('value') is None):
+                    continue
+                subjects.append(resource['subject']['reference'].split('/')[-1])
+                values.append(quantity['value'])
+                units.append(quantity.get('code', quantity.get('unit')))
+                effective = resource.get('effectiveDateTime')
+                # Time zone offsets are dropped, NumPy datetimes are naive
+                dates.append(effective[:19] if effective else 'NaT')
+            nextLinks = [link['url'] for link in bundle.get('link', []) if link['relation'] == 'next']
+            if (len(nextLinks) == 0):
+                break
+            bundle = pageServer.request_json(nextLinks[0].split('/')[-1])
+        return subjects, values, units, dates
+
+    def _getOrCreateNode(self, className, name):
+        node = slicer.mrmlScene.GetFirstNodeByName(name)
+        if (node is None or not node.IsA(className)):
+            node = slicer.mrmlScene.AddNewNodeByClass(className, name)
+        return node
+
+    def computeCohortSummary(self, bins=30):
+        """
+        Summarize self.cohortObservations into table nodes (statistics, histogram, latest value per patient)
+        and a histogram plot chart node. Returns the statistics table node.
+        """
+        observations = self.cohortObservations
+        summary, binCenters, counts = CohortStatistics.summarize(observations['values'], bins=bins)
+        latestPatients, latestDates, latestValues = CohortStatistics.latestPerPatient(
+            observations['patients'], observations['dates'], observations['values'])
+        latestSummary = CohortStatistics.summarize(latestValues, bins=bins)[0]
+
+        summaryTableNode = self._getOrCreateNode('vtkMRMLTableNode', 'CohortSummary_TableNode')
+        summaryTableNode.SetLocked(False)
+        summaryTableNode.RemoveAllColumns()
+        rows = [('Code', observations['code'], ''), ('Unit', str(observations['unit']), ''),
+            ('Patients', str(len(latestPatients)), ''),
+            ('Discarded (incompatible unit)', str(observations['discarded']), '')]
+        rows += [(name, '{0:g}'.format(value), '{0:g}'.format(latestSummary[name])) for name, value in summary.items()]
+        for columnIndex, columnName in enumerate(['Statistic', 'All Observations', 'Latest per Patient']):
+            columnArray = vtk.vtkStringArray()
+            columnArray.SetName(columnName)
+            for row in rows:
+                columnArray.InsertNextValue(row[columnIndex])
+            summaryTableNode.AddColumn(columnArray)
+        summaryTableNode.SetLocked(True)
+
+        histogramTableNode = self._getOrCreateNode('vtkMRMLTableNode', 'CohortHistogram_TableNode')
+        slicer.util.updateTableFromArray(histogramTableNode, [binCenters, counts.astype(float)], ['Bin Center', 'Count'])
+        plotSeriesNode = self._getOrCreateNode('vtkMRMLPlotSeriesNode', 'CohortHistogram')
+        plotSeriesNode.SetAndObserveTableNodeID(histogramTableNode.GetID())
+        plotSeriesNode.SetXColumnName('Bin Center')
+        plotSeriesNode.SetYColumnName('Count')
+        plotSeriesNode.SetPlotType(slicer.vtkMRMLPlotSeriesNode.PlotTypeBar)
+        plotChartNode = self._getOrCreateNode('vtkMRMLPlotChartNode', 'CohortHistogram_PlotChart')
+        plotChartNode.SetAndObservePlotSeriesNodeID(plotSeriesNode.GetID())
+        plotChartNode.SetTitle(observations['code'])
+        plotChartNode.SetXAxisTitle(str(observations['unit']))
+        plotChartNode.SetYAxisTitle('Observations')
+
+        latestTableNode = self._getOrCreateNode('vtkMRMLTableNode', 'CohortLatestValues_TableNode')
+        latestTableNode.RemoveAllColumns()
+        patientArray = vtk.vtkStringArray()
+        patientArray.SetName('Patient id')
+        dateArray = vtk.vtkStringArray()
+        dateArray.SetName('Date')
+        valueArray = vtk.vtkDoubleArray()
+        valueArray.SetName('Value ({0})'.format(observations['unit']))
+        for patientID, date, value in zip(latestPatients, latestDates.astype(str), latestValues):
+            patientArray.InsertNextValue(patientID)
+            dateArray.InsertNextValue(date if date != 'NaT' else "")
+            valueArray.InsertNextValue(value)
+        latestTableNode.AddColumn(patientArray)
+        latestTableNode.AddColumn(dateArray)
+        latestTableNode.AddColumn(valueArray)
+
+        return summaryTableNode
+
+    def openDICOMIndex(self):
+        """
+        Open the local study/series index of the current DICOMweb server, without refreshing it.
+        """
+        databasePath = os.path.join(slicer.app.cachePath, 'FHIRReaderDICOMIndex.sqlite')
+        if (self.dicomIndex is None or self.dicomIndex.serverURL != self.dicomURL):
+            self.dicomIndex = DICOMIndex.DICOMIndex(databasePath, self.dicomURL)
+
+    def startDICOMIndexRefresh(self, full=False):
+        """
+        Build or incrementally refresh the local study/series index of the DICOMweb server in the background.
+        A full refresh re-sweeps all study dates, picking up studies whose date changed since the last sweep.
+        """
+        self.openDICOMIndex()
+        self.dicomIndex.startRefresh(self.createDICOMClient(), full)
+
+    def patientHasImaging(self, patientID):
+        """
+        Return True if the DICOM index holds studies of the patient. Studies without a StudyDate are not
+        found by the index sweeps, so False does not mean that the patient has no imaging.
+        """
+        return self.dicomIndex is not None and patientID is not None and self.dicomIndex.hasImaging(patientID)
+
     def fetchStudiesAndSeries(self, patientID):     
         self.selectedDICOM = []
         if (patientID is None):
             return
+        if (self.dicomIndex is not None):
+            indexed = self.dicomIndex.lookup(patientID)
+            if (indexed is not None):
+                self.selectedDICOM = indexed
+                return
         with BusyCursor.BusyCursor():
             offset = 0
             studies = []
@@ -659,8 +1098,127 @@ class FHIRReaderLogic(ScriptedLoadableModuleLogic):
                     seriesInfo.append(serieInfo)
                 studyInfo['series'] = seriesInfo
                 self.selectedDICOM.append(studyInfo)
+            if (self.dicomIndex is not None and len(self.selectedDICOM)):
+                self.dicomIndex.store(patientID, self.selectedDICOM)
+
+    def createDICOMClient(self):
+        """
+        Return a new client of the current DICOMweb server, for use by a single background thread.
+        Clients hold a requests session, and requests sessions should not be shared between threads.
+        """
+        return DICOMwebClient(url=self.dicomURL)
 
-    def fetchInstances(self, studyUID, seriesUID):
+    def loadSeriesLazily(self, studyUID, seriesUID):
+        """
+        Create a volume for a large series from its metadata and retrieve its frames on demand.
+        Returns the volume node ID, or None if the series is small or its frames do not form a
+        single regular stack, in which case it should be loaded from complete instances.
+        """
+        with BusyCursor.BusyCursor():
+            try:
+                metadata = self.dicomClient.retrieve_series_metadata(study_instance_uid=studyUID, series_instance_uid=seriesUID)
+                frameCount = LazySeries.LazySeriesVolume.countFrames(metadata)
+            except BaseException as e:
+                logging.info('Metadata of series {0} cannot be retrieved, retrieving all instances: {1}'.format(seriesUID, e))
+                return None
+            if (frameCount < self.lazyLoadingFrameThreshold):
+                return None
+            try:
+                lazyVolume = LazySeries.LazySeriesVolume(self.createDICOMClient, studyUID, seriesUID, metadata)
+            except (ValueError, AttributeError, KeyError, IndexError) as e:
+                logging.info('Series {0} cannot be loaded lazily, retrieving all instances: {1}'.format(seriesUID, e))
+                return None
+            try:
+                lazyVolume.probe()
+            except BaseException as e:
+                logging.info('Frames of series {0} cannot be retrieved, retrieving all instances: {1}'.format(seriesUID, e))
+                return None
+
+            # Forget volumes that were removed from the scene
+            self.lazyVolumes = {nodeID: volume for nodeID, volume in self.lazyVolumes.items()
+                if volume.volumeNode.GetScene() is not None}
+
+            volumeNode = lazyVolume.createVolumeNode()
+            self.addVolumeToSubjectHierarchy(volumeNode, lazyVolume.patientID, studyUID, lazyVolume.studyDescription, seriesUID,
+                lazyVolume.instanceUIDs, lazyVolume.hierarchyAttributes)
+            self.lazyVolumes[volumeNode.GetID()] = lazyVolume
+            return volumeNode.GetID()
+
+    def addVolumeToSubjectHierarchy(self, volumeNode, patientID, studyUID, studyName, seriesUID, instanceUIDs, dicomAttributes):
+        """
+        Place a volume that was not loaded through the DICOM database under patient and study items
+        carrying DICOM UIDs and attributes, the same way DICOMUtils.loadSeriesByUID does.
+        dicomAttributes holds values of DICOMPipeline.hierarchyKeywords.
+        """
+        shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+        constants = slicer.vtkMRMLSubjectHierarchyConstants
+        dicomUIDName = constants.GetDICOMUIDName()
+        patientItem = shNode.GetItemByUID(dicomUIDName, patientID)
+        if (not patientItem):
+            patientItem = shNode.CreateSubjectItem(shNode.GetSceneItemID(), dicomAttributes.get('PatientName', patientID))
+            shNode.SetItemUID(patientItem, dicomUIDName, patientID)
+            shNode.SetItemAttribute(patientItem, constants.GetDICOMPatientIDAttributeName(), patientID)
+            self._setItemAttributes(shNode, patientItem, dicomAttributes, {
+                'PatientName': constants.GetDICOMPatientNameAttributeName(),
+                'PatientSex': constants.GetDICOMPatientSexAttributeName(),
+                'PatientBirthDate': constants.GetDICOMPatientBirthDateAttributeName()})
+        studyItem = shNode.GetItemByUID(dicomUIDName, studyUID)
+        if (not studyItem):
+            studyItem = shNode.CreateStudyItem(patientItem, studyName if studyName else studyUID)
+            shNode.SetItemUID(studyItem, dicomUIDName, studyUID)
+            shNode.SetItemAttribute(studyItem, constants.GetDICOMStudyDescriptionAttributeName(), str(studyName))
+            self._setItemAttributes(shNode, studyItem, dicomAttributes, {
+                'StudyDate': constants.GetDICOMStudyDateAttributeName(),
+                'StudyTime': constants.GetDICOMStudyTimeAttributeName()})
+        volumeItem = shNode.GetItemByDataNode(volumeNode)
+        shNode.SetItemUID(volumeItem, dicomUIDName, seriesUID)
+        self._setItemAttributes(shNode, volumeItem, dicomAttributes, {
+            'Modality': constants.GetDICOMSeriesModalityAttributeName(),
+            'SeriesNumber': constants.GetDICOMSeriesNumberAttributeName()})
+        shNode.SetItemParent(volumeItem, studyItem)
+        volumeNode.SetAttribute('DICOM.instanceUIDs', ' '.join(instanceUIDs))
+
+    def _setItemAttributes(self, shNode, item, dicomAttributes, attributeNames):
+        for keyword, attributeName in attributeNames.items():
+            if (keyword in dicomAttributes):
+                shNode.SetItemAttribute(item, attributeName, dicomAttributes[keyword])
+
+    def getParseExecutor(self, startTimeout=60):
+        """
+        Return the pool parsing retrieved instances, using one worker process per core. Falls back to threads
+        if worker processes cannot be started.
+        """
+        if (self.parseExecutor is None):
+            self.parseExecutor = self._startProcessPool(startTimeout)
+        if (self.parseExecutor is None):
+            self.parseExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
+        return self.parseExecutor
+
+    def _startProcessPool(self, startTimeout):
+        # Spawned workers run sys.executable, which is the Slicer application itself, so they are started
+        # with the PythonSlicer interpreter shipped next to it instead.
+        applicationDir = slicer.app.applicationDirPath
+        pythonExecutable = shutil.which('PythonSlicer', path=os.pathsep.join([applicationDir, os.path.join(applicationDir, '..', 'bin')]))
+        if (pythonExecutable is None):
+            logging.info('Parsing DICOM instances in threads, PythonSlicer was not found in {0}'.format(applicationDir))
+            return None
+        context = multiprocessing.get_context('spawn')
+        context.set_executable(pythonExecutable)
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=context)
+        # Workers are only started by the first submitted task, so check that they run before any download
+        try:
+            executor.submit(DICOMPipeline.ping).result(timeout=startTimeout)
+        except (concurrent.futures.BrokenExecutor, concurrent.futures.TimeoutError, OSError) as e:
+            logging.info('Parsing DICOM instances in threads, worker processes could not be started: {0}'.format(e))
+            executor.shutdown(wait=False, cancel_futures=True)
+            return None
+        return executor
+
+    def fetchInstances(self, studyUID, seriesUID, seriesParser=None):
+        """
+        Download the instances of a series into the temp folder. If seriesParser is given, each instance
+        is submitted to it as soon as it is written.
+        """
         if not os.path.exists('temp/'):
             os.makedirs('temp')
         
@@ -672,7 +1230,41 @@ class FHIRReaderLogic(ScriptedLoadableModuleLogic):
                     study_instance_uid=studyUID,
                     series_instance_uid=seriesUID,
                     sop_instance_uid=instanceUID)
-                pydicom.filewriter.write_file('temp/file_'+str(instanceIndex)+'.dcm', retrievedInstance)        
+                path = 'temp/file_'+str(instanceIndex)+'.dcm'
+                pydicom.filewriter.write_file(path, retrievedInstance)        
+                if (seriesParser is not None):
+                    seriesParser.submit(os.path.abspath(path))
+
+    def fetchAndLoadSeries(self, studyUID, seriesUID):
+        """
+        Download a series while its instances are parsed and decoded in the parse pool, then build the volume
+        directly from the sorted slices. Returns the volume node ID, or None if the series is not a single
+        regular stack of decodable slices; the downloaded instances are then left in the temp folder to be
+        loaded through the DICOM database.
+        """
+        seriesParser = DICOMPipeline.SeriesParser(self.getParseExecutor())
+        self.fetchInstances(studyUID, seriesUID, seriesParser)
+        with BusyCursor.BusyCursor():
+            slices = seriesParser.results()
+            if (seriesParser.broken):
+                self.parseExecutor.shutdown(wait=False)
+                self.parseExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
+            try:
+                voxels, geometry = DICOMPipeline.assembleVolume(slices)
+            except ValueError as e:
+                logging.info('Series {0} is loaded through the DICOM database: {1}'.format(seriesUID, e))
+                return None
+
+            first = slices[0]
+            volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode',
+                first['seriesDescription'] if first['seriesDescription'] else seriesUID)
+            volumeNode.SetIJKToRASMatrix(LazySeries.ijkToRASMatrix(geometry['origin'], geometry['rowDirection'],
+                geometry['columnDirection'], geometry['pixelSpacing'], geometry['sliceSpacing']))
+            slicer.util.updateVolumeFromArray(volumeNode, voxels)
+            LazySeries.applyWindowLevel(volumeNode, first['windowCenter'], first['windowWidth'])
+            self.addVolumeToSubjectHierarchy(volumeNode, first['patientID'], studyUID, first['studyDescription'], seriesUID,
+                geometry['instanceUIDs'], first['hierarchyAttributes'])
+            return volumeNode.GetID()
 
 
 #
@@ -696,6 +1288,8 @@ class FHIRReaderTest(ScriptedLoadableModuleTest):
         """
         self.setUp()
         self.test_FHIRReader1()
+        self.test_CohortStatistics()
+        self.test_DICOMPipeline()
 
     def test_FHIRReader1(self):
         """ Ideally you should have several levels of tests.  At the lowest level
@@ -712,3 +1306,187 @@ class FHIRReaderTest(ScriptedLoadableModuleTest):
         self.delayDisplay("Starting the test")
 
         self.delayDisplay('Test passed')
+
+    def test_CohortStatistics(self):
+        """ Check unit parsing, unit normalization and cohort aggregation, which need no server.
+        """
+
+        self.delayDisplay("Starting the cohort statistics test")
+
+        # Prefixes are only split off when the rest is a known unit: m is meter, min is minute, d is day
+        self.assertEqual(CohortStatistics.parseUcumUnit('m'), ('length1', 1.0, 0.0))
+        self.assertEqual(CohortStatistics.parseUcumUnit('mm')[:2], ('length1', 1e-3))
+        self.assertEqual(CohortStatistics.parseUcumUnit('min'), ('time1', 60.0, 0.0))
+        self.assertEqual(CohortStatistics.parseUcumUnit('d'), ('time1', 86400.0, 0.0))
+        self.assertEqual(CohortStatistics.parseUcumUnit('mg/dL')[0], 'mass1.volume-1')
+        self.assertAlmostEqual(CohortStatistics.parseUcumUnit('mg/dL')[1], 1e-2)
+        self.assertEqual(CohortStatistics.parseUcumUnit('{beats}/min')[0], 'time-1')
+        self.assertAlmostEqual(CohortStatistics.parseUcumUnit('10*3/uL')[1], 1e9)
+        self.assertIsNone(CohortStatistics.parseUcumUnit('foo'))
+        # Ratios keep their cancelled dimension so that they are not commensurable with percentages
+        self.assertEqual(CohortStatistics.parseUcumUnit('mmol/mol')[0], 'amount0')
+        self.assertEqual(CohortStatistics.parseUcumUnit('%'), ('', 1e-2, 0.0))
+        # Offset units are only understood on their own
+        self.assertEqual(CohortStatistics.parseUcumUnit('Cel'), ('temperature1', 1.0, 273.15))
+        self.assertIsNone(CohortStatistics.parseUcumUnit('Cel/s'))
+
+        values, unit, keep = CohortStatistics.normalizeUnits([37.0, 98.6, 36.5], ['Cel', '[degF]', 'Cel'])
+        self.assertEqual(unit, 'Cel')
+        self.assertTrue(np.all(keep))
+        np.testing.assert_allclose(values, [37.0, 37.0, 36.5])
+
+        values, unit, keep = CohortStatistics.normalizeUnits([1.0, 100.0, 0.5], ['g/L', 'mg/dL', 'g/L'])
+        self.assertEqual(unit, 'g/L')
+        np.testing.assert_allclose(values, [1.0, 1.0, 0.5])
+
+        values, unit, keep = CohortStatistics.normalizeUnits([48.0, 6.0, 6.5], ['mmol/mol', '%', '%'])
+        self.assertEqual(unit, '%')
+        self.assertEqual(keep.tolist(), [False, True, True])
+        values, unit, keep = CohortStatistics.normalizeUnits([48.0, 6.0, 6.5], ['mmol/mol', '%', '%'],
+            CohortStatistics.knownConversions['http://loinc.org|4548-4'])
+        self.assertTrue(np.all(keep))
+        np.testing.assert_allclose(values, [0.09148 * 48.0 + 2.152, 6.0, 6.5])
+        values, unit, keep = CohortStatistics.normalizeUnits([48.0, 48.0, 6.5], ['mmol/mol', 'mmol/mol', '%'],
+            CohortStatistics.knownConversions['http://loinc.org|4548-4'])
+        self.assertEqual(unit, 'mmol/mol')
+        np.testing.assert_allclose(values, [48.0, 48.0, (6.5 - 2.152) / 0.09148])
+
+        values, unit, keep = CohortStatistics.normalizeUnits([], [])
+        self.assertIsNone(unit)
+        self.assertEqual(len(keep), 0)
+
+        # Undated observations are only used for patients without a dated one
+        patients = np.array(['a', 'a', 'a', 'b'])
+        dates = np.array(['2020-01-01', 'NaT', '2019-01-01', 'NaT'], dtype='datetime64[s]')
+        latestPatients, latestDates, latestValues = CohortStatistics.latestPerPatient(patients, dates, np.array([1.0, 2.0, 3.0, 4.0]))
+        self.assertEqual(latestPatients.tolist(), ['a', 'b'])
+        self.assertEqual(latestValues.tolist(), [1.0, 4.0])
+        self.assertTrue(np.isnat(latestDates[1]))
+
+        summary, centers, counts = CohortStatistics.summarize(np.array([1.0, 2.0, 3.0, 4.0, 5.0]), bins=2)
+        self.assertEqual(summary['Count'], 5)
+        self.assertEqual(summary['Percentile 50'], 3.0)
+        self.assertEqual(summary['Maximum'], 5.0)
+        self.assertEqual(centers.tolist(), [2.0, 4.0])
+        self.assertEqual(counts.tolist(), [2, 3])
+        summary, centers, counts = CohortStatistics.summarize(np.zeros(0))
+        self.assertEqual(list(summary.items()), [('Count', 0)])
+
+        self.delayDisplay('Test passed')
+
+    def test_DICOMPipeline(self):
+        """ Check slice sorting, voxel types and volume assembly of the parse pipeline, which need no server.
+        """
+
+        self.delayDisplay("Starting the DICOM pipeline test")
+
+        axial = [1, 0, 0, 0, 1, 0]
+        order, rowDirection, columnDirection, normal, sliceSpacing = DICOMPipeline.sortFrames(
+            [[0, 0, 5], [0, 0, 1], [0, 0, 3]], [axial] * 3)
+        self.assertEqual(order.tolist(), [1, 2, 0])
+        self.assertEqual(normal.tolist(), [0, 0, 1])
+        self.assertAlmostEqual(sliceSpacing, 2.0)
+        # With the normal pointing down, slices are sorted from the top
+        order, rowDirection, columnDirection, normal, sliceSpacing = DICOMPipeline.sortFrames(
+            [[0, 0, 1], [0, 0, 5], [0, 0, 3]], [[1, 0, 0, 0, -1, 0]] * 3)
+        self.assertEqual(order.tolist(), [1, 2, 0])
+        self.assertEqual(normal.tolist(), [0, 0, -1])
+        self.assertAlmostEqual(sliceSpacing, 2.0)
+        # Oblique stacks are fine as long as positions follow the normal
+        oblique = [1, 0, 0, 0, 0.8, 0.6]
+        obliqueNormal = np.cross(oblique[:3], oblique[3:])
+        order, rowDirection, columnDirection, normal, sliceSpacing = DICOMPipeline.sortFrames(
+            [(obliqueNormal * 2.5 * index).tolist() for index in range(4)], [oblique] * 4)
+        self.assertAlmostEqual(sliceSpacing, 2.5)
+        with self.assertRaises(ValueError):
+            # Gantry tilt: positions shift along the column direction from slice to slice
+            DICOMPipeline.sortFrames([[0, 0.3 * index, index] for index in range(4)], [axial] * 4)
+        with self.assertRaises(ValueError):
+            DICOMPipeline.sortFrames([[0, 0, 0], [0, 0, 1], [0, 0, 1]], [axial] * 3)
+        with self.assertRaises(ValueError):
+            DICOMPipeline.sortFrames([[0, 0, 0], [0, 0, 1], [0, 0, 3]], [axial] * 3)
+        with self.assertRaises(ValueError):
+            DICOMPipeline.sortFrames([[0, 0, 0], [0, 0, 1]], [axial, [1, 0, 0, 0, 0, 1]])
+
+        self.assertEqual(DICOMPipeline.rescaledDtype(np.uint16, 12, [1, 1], [0, 0]), np.dtype(np.uint16))
+        self.assertEqual(DICOMPipeline.rescaledDtype(np.uint16, 12, [1, 1], [-1024, -1024]), np.dtype(np.int16))
+        self.assertEqual(DICOMPipeline.rescaledDtype(np.uint16, 16, [1, 1], [-1024, -1024]), np.dtype(np.int32))
+        self.assertEqual(DICOMPipeline.rescaledDtype(np.int16, 16, [1, 1], [-1024, -1024]), np.dtype(np.int32))
+        self.assertEqual(DICOMPipeline.rescaledDtype(np.uint16, 12, [1, 1], [-1024, 0]), np.dtype(np.float32))
+        self.assertEqual(DICOMPipeline.rescaledDtype(np.uint16, 12, [2, 2], [0, 0]), np.dtype(np.float32))
+        self.assertEqual(DICOMPipeline.rescaledDtype(np.uint16, 12, [1, 1], [0.5, 0.5]), np.dtype(np.float32))
+
+        def makeSlice(index, z, intercept=-1024.0, photometricInterpretation='MONOCHROME2'):
+            return {'path': 'slice{0}.dcm'.format(index), 'pixels': np.full((2, 3), 1000 + index, dtype=np.uint16),
+                'position': [0.0, 0.0, z], 'orientation': axial, 'spacing': [0.5, 0.7], 'sliceThickness': 3.0,
+                'slope': 1.0, 'intercept': intercept, 'bitsStored': 12, 'sopInstanceUID': '1.2.{0}'.format(index),
+                'photometricInterpretation': photometricInterpretation}
+        slices = [makeSlice(0, 6.0), makeSlice(1, 0.0), makeSlice(2, 3.0)]
+        voxels, geometry = DICOMPipeline.assembleVolume(slices)
+        self.assertEqual(voxels.shape, (3, 2, 3))
+        self.assertEqual(voxels.dtype, np.int16)
+        self.assertEqual(voxels[:, 0, 0].tolist(), [1001 - 1024, 1002 - 1024, 1000 - 1024])
+        self.assertEqual(geometry['instanceUIDs'], ['1.2.1', '1.2.2', '1.2.0'])
+        self.assertEqual(geometry['origin'].tolist(), [0.0, 0.0, 0.0])
+        self.assertAlmostEqual(geometry['sliceSpacing'], 3.0)
+        voxels, geometry = DICOMPipeline.assembleVolume([makeSlice(0, 0.0, intercept=0.5)])
+        self.assertEqual(voxels.dtype, np.float32)
+        self.assertEqual(voxels[0, 0, 0], 1000.5)
+        self.assertAlmostEqual(geometry['sliceSpacing'], 3.0)
+        with self.assertRaises(ValueError):
+            DICOMPipeline.assembleVolume([makeSlice(0, 0.0), makeSlice(1, 1.0, photometricInterpretation='MONOCHROME1')])
+        unreadable = makeSlice(1, 1.0)
+        unreadable['pixels'] = None
+        with self.assertRaises(ValueError):
+            DICOMPipeline.assembleVolume([makeSlice(0, 0.0), unreadable])
+        with self.assertRaises(ValueError):
+            DICOMPipeline.assembleVolume([])
+
+        # Parse instances written to disk, in threads as when worker processes are not available
+        with tempfile.TemporaryDirectory() as directory:
+            paths = []
+            for index in range(3):
+                ds = pydicom.dataset.Dataset()
+                ds.file_meta = pydicom.dataset.FileMetaDataset()
+                ds.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+                ds.file_meta.MediaStorageSOPClassUID = pydicom.uid.CTImageStorage
+                ds.file_meta.MediaStorageSOPInstanceUID = '1.2.{0}'.format(index)
+                ds.SOPClassUID = pydicom.uid.CTImageStorage
+                ds.SOPInstanceUID = '1.2.{0}'.format(index)
+                ds.PatientID = 'patient'
+                ds.PatientName = 'Doe^Jane'
+                ds.Modality = 'CT'
+                ds.SeriesNumber = 4
+                ds.ImagePositionPatient = [0, 0, 2 - index]
+                ds.ImageOrientationPatient = axial
+                ds.PixelSpacing = [0.5, 0.7]
+                ds.RescaleSlope = 1
+                ds.RescaleIntercept = -1024
+                ds.WindowCenter = [40, 400]
+                ds.WindowWidth = [400, 2000]
+                ds.Rows, ds.Columns = 2, 3
+                ds.SamplesPerPixel = 1
+                ds.PhotometricInterpretation = 'MONOCHROME2'
+                ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 12, 11, 0
+                ds.PixelData = np.full((2, 3), index, dtype='<u2').tobytes()
+                path = os.path.join(directory, '{0}.dcm'.format(index))
+                pydicom.dcmwrite(path, ds, write_like_original=False)
+                paths.append(path)
+            paths.append(os.path.join(directory, 'missing.dcm'))
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                seriesParser = DICOMPipeline.SeriesParser(executor)
+                for path in paths:
+                    seriesParser.submit(path)
+                slices = seriesParser.results()
+            self.assertEqual([instance['path'] for instance in slices], paths)
+            self.assertIsNone(slices[3]['pixels'])
+            self.assertIn('error', slices[3])
+            self.assertEqual(slices[0]['windowCenter'], 40.0)
+            self.assertEqual(slices[0]['hierarchyAttributes'], {'PatientName': 'Doe^Jane', 'Modality': 'CT', 'SeriesNumber': '4'})
+
+            voxels, geometry = DICOMPipeline.assembleVolume(slices[:3])
+            self.assertEqual(voxels[:, 0, 0].tolist(), [2 - 1024, 1 - 1024, 0 - 1024])
+            self.assertEqual(geometry['instanceUIDs'], ['1.2.2', '1.2.1', '1.2.0'])
+
+        self.delayDisplay('Test passed')
@@ -0,0 +1,167 @@
+import collections
+import re
+
+import numpy as np
+
+# UCUM prefixes and the base units needed for common laboratory and vital sign observations.
+# Each unit maps to (dimension, factor to the base unit of that dimension, offset to the base unit).
+_PREFIXES = {'': 1.0, 'k': 1e3, 'h': 1e2, 'da': 1e1, 'd': 1e-1, 'c': 1e-2, 'm': 1e-3, 'u': 1e-6, 'n': 1e-9, 'p': 1e-12, 'f': 1e-15}
+_ATOMS = {
+    'g': ('mass', 1.0, 0.0),
+    'L': ('volume', 1.0, 0.0),
+    'l': ('volume', 1.0, 0.0),
+    'mol': ('amount', 1.0, 0.0),
+    'eq': ('equivalents', 1.0, 0.0),
+    'm': ('length', 1.0, 0.0),
+    's': ('time', 1.0, 0.0),
+    'U': ('enzyme', 1.0, 0.0),
+    '[IU]': ('international unit', 1.0, 0.0),
+    '[iU]': ('international unit', 1.0, 0.0),
+    'Pa': ('pressure', 1.0, 0.0),
+    'K': ('temperature', 1.0, 0.0),
+    }
+# Units that do not take prefixes
+_SPECIAL_ATOMS = {
+    '1': ('', 1.0, 0.0),
+    '%': ('', 1e-2, 0.0),
+    'min': ('time', 60.0, 0.0),
+    'h': ('time', 3600.0, 0.0),
+    'd': ('time', 86400.0, 0.0),
+    'wk': ('time', 604800.0, 0.0),
+    'a': ('time', 31557600.0, 0.0),
+    'mo': ('time', 2629800.0, 0.0),
+    '[lb_av]': ('mass', 453.59237, 0.0),
+    '[oz_av]': ('mass', 28.349523125, 0.0),
+    '[in_i]': ('length', 0.0254, 0.0),
+    '[ft_i]': ('length', 0.3048, 0.0),
+    'mm[Hg]': ('pressure', 133.322387415, 0.0),
+    'Cel': ('temperature', 1.0, 273.15),
+    '[degF]': ('temperature', 5.0 / 9.0, 459.67 * 5.0 / 9.0),
+    }
+# Conversions between units of different dimensions that only hold for a given observation code,
+# as {code: {(source unit, target unit): (factor, offset)}} with target = source * factor + offset.
+knownConversions = {
+    # HbA1c, IFCC (mmol/mol) to NGSP (%) master equation
+    'http://loinc.org|4548-4': {('mmol/mol', '%'): (0.09148, 2.152)},
+    'http://loinc.org|59261-8': {('mmol/mol', '%'): (0.09148, 2.152)},
+    }
+
+_TERM = re.compile(r'^(?P<atom>.+?)(?P<exponent>-?\d+)?$')
+
+def parseUcumUnit(code):
+    """
+    Return (dimension, factor, offset) of a UCUM unit code such that base = value * factor + offset,
+    or None if the unit is not understood. Only products of the form "a.b/c" are supported.
+    """
+    if code is None:
+        return None
+    code = re.sub(r'\{[^}]*\}', '', code).strip() or '1'
+    if code in _SPECIAL_ATOMS and _SPECIAL_ATOMS[code][2] != 0.0:
+        baseDimension, baseFactor, baseOffset = _SPECIAL_ATOMS[code]
+        return (baseDimension + '1', baseFactor, baseOffset)
+
+    dimension = collections.Counter()
+    factor = 1.0
+    parts = code.split('/')
+    for partIndex, part in enumerate(parts):
+        sign = 1 if partIndex == 0 else -1
+        for term in (part.split('.') if part else ['1']):
+            match = _TERM.match(term)
+            if match is None:
+                return None
+            atom = match.group('atom')
+            exponent = int(match.group('exponent')) if match.group('exponent') else 1
+            if atom in ('10*', '10^'):
+                # Power of ten such as 10*3 in 10*3/uL, the exponent applies to 10
+                unit = ('', 10.0, 0.0)
+            elif atom in _SPECIAL_ATOMS:
+                unit = _SPECIAL_ATOMS[atom]
+            else:
+                unit = None
+                for prefix in sorted(_PREFIXES, key=len, reverse=True):
+                    if atom.startswith(prefix) and atom[len(prefix):] in _ATOMS:
+                        baseDimension, baseFactor, _ = _ATOMS[atom[len(prefix):]]
+                        unit = (baseDimension, _PREFIXES[prefix] * baseFactor, 0.0)
+                        break
+                if unit is None:
+                    return None
+            if unit[2] != 0.0:
+                # Offset units (degrees Celsius/Fahrenheit) cannot be combined with other units
+                return None
+            if unit[0]:
+                dimension[unit[0]] += sign * exponent
+            factor *= unit[1] ** (sign * exponent)
+    # Dimensions that cancel out are kept with power 0, so that ratios such as mmol/mol are not
+    # considered commensurable with plain numbers or percentages.
+    dimensionKey = '.'.join('{0}{1}'.format(name, power) for name, power in sorted(dimension.items()))
+    return (dimensionKey, factor, 0.0)
+
+def normalizeUnits(values, units, conversions=None):
+    """
+    Convert values to the most frequent unit among those commensurable with it, or related to it by one of
+    the given conversions (see knownConversions).
+    Returns (values, targetUnit, keep) where keep is a boolean mask of the values that could be converted.
+    """
+    conversions = conversions or {}
+    values = np.asarray(values, dtype=np.float64)
+    units = np.asarray(units, dtype=object)
+    if len(values) == 0:
+        return values, None, np.zeros(0, dtype=bool)
+
+    uniqueUnits, inverse, counts = np.unique(units.astype(str), return_inverse=True, return_counts=True)
+    targetUnit = str(uniqueUnits[np.argmax(counts)])
+    target = parseUcumUnit(targetUnit)
+
+    converted = np.full(len(values), np.nan)
+    for unitIndex, unit in enumerate(uniqueUnits):
+        mask = inverse == unitIndex
+        if unit == targetUnit:
+            converted[mask] = values[mask]
+            continue
+        if (unit, targetUnit) in conversions:
+            factor, offset = conversions[(unit, targetUnit)]
+            converted[mask] = values[mask] * factor + offset
+            continue
+        if (targetUnit, unit) in conversions:
+            factor, offset = conversions[(targetUnit, unit)]
+            converted[mask] = (values[mask] - offset) / factor
+            continue
+        source = parseUcumUnit(unit)
+        if source is None or target is None or source[0] != target[0]:
+            continue
+        converted[mask] = (values[mask] * source[1] + source[2] - target[2]) / target[1]
+
+    keep = ~np.isnan(converted)
+    return converted, targetUnit, keep
+
+def latestPerPatient(patients, dates, values):
+    """
+    Return (patients, dates, values) of the most recent observation of each patient.
+    Observations without a date are only used when a patient has no dated observation.
+    """
+    if len(patients) == 0:
+        return patients, dates, values
+    patientCodes = np.unique(patients, return_inverse=True)[1]
+    sortableDates = np.where(np.isnat(dates), np.datetime64('0001-01-01T00:00:00'), dates)
+    order = np.lexsort((sortableDates, patientCodes))
+    sortedCodes = patientCodes[order]
+    isLast = np.r_[sortedCodes[1:] != sortedCodes[:-1], True]
+    latest = order[isLast]
+    return patients[latest], dates[latest], values[latest]
+
+def summarize(values, percentiles=(5, 25, 50, 75, 95), bins=30):
+    """
+    Compute descriptive statistics and a histogram of values.
+    """
+    summary = collections.OrderedDict()
+    summary['Count'] = len(values)
+    if len(values) == 0:
+        return summary, np.zeros(0), np.zeros(0, dtype=int)
+    summary['Mean'] = float(np.mean(values))
+    summary['Standard Deviation'] = float(np.std(values))
+    summary['Minimum'] = float(np.min(values))
+    for percentile, value in zip(percentiles, np.percentile(values, percentiles)):
+        summary['Percentile {0}'.format(percentile)] = float(value)
+    summary['Maximum'] = float(np.max(values))
+    counts, edges = np.histogram(values, bins=bins)
+    return summary, (edges[:-1] + edges[1:]) / 2, counts
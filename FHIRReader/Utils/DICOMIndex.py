@@ -0,0 +1,220 @@
+import datetime
+import sqlite3
+import threading
+
+import pydicom
+
+class DICOMIndex:
+    """
+    Local PatientID -> study/series index of a DICOMweb server, stored in SQLite.
+
+    The index is filled by bulk QIDO study and series sweeps paged by StudyDate, so that opening a patient
+    does not require per-patient QIDO queries. Lookups go through an in-memory dictionary keyed
+    by PatientID which is rebuilt from the database after every sweep.
+
+    Studies without a StudyDate cannot be matched by a date range, so a patient missing from the
+    index may still have imaging; callers should fall back to per-patient queries in that case.
+    """
+
+    # Date windows that still return a full page on servers that ignore offset are split in half
+    # until they fit in a single page (or span a single day).
+    pageSize = 1000
+
+    # Sweeps run up to this date so that studies dated in the future are indexed too
+    lastDate = datetime.date(9999, 12, 31)
+
+    def __init__(self, databasePath, serverURL):
+        self.databasePath = databasePath
+        self.serverURL = serverURL
+        self.isBuilding = False
+        self.lastError = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._patientIndex = {}
+        with self._connect() as connection:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS studies (
+                    server TEXT, study_uid TEXT, patient_id TEXT, study_date TEXT, description TEXT,
+                    PRIMARY KEY (server, study_uid));
+                CREATE INDEX IF NOT EXISTS studies_patient ON studies (server, patient_id);
+                CREATE TABLE IF NOT EXISTS series (
+                    server TEXT, study_uid TEXT, series_uid TEXT, series_number INTEGER, description TEXT,
+                    PRIMARY KEY (server, series_uid));
+                CREATE INDEX IF NOT EXISTS series_study ON series (server, study_uid);
+                CREATE TABLE IF NOT EXISTS sweeps (
+                    server TEXT PRIMARY KEY, last_study_date TEXT);
+                """)
+            row = connection.execute("SELECT last_study_date FROM sweeps WHERE server = ?", (self.serverURL,)).fetchone()
+        self._lastSweepDate = row[0] if row is not None else None
+        self._loadPatientIndex()
+
+    def _connect(self):
+        # A connection is opened per operation so that the index can be used from the sweep thread
+        # and from Slicer's main thread without sharing sqlite objects across threads.
+        return sqlite3.connect(self.databasePath, timeout=30)
+
+    def hasImaging(self, patientID):
+        """
+        True if the index holds studies of the patient. False only means that none were indexed.
+        """
+        return patientID in self._patientIndex
+
+    def lookup(self, patientID):
+        """
+        Return the studies of the patient in the same layout as FHIRReaderLogic.selectedDICOM,
+        or None if the patient is not in the index.
+        """
+        with self._lock:
+            studies = self._patientIndex.get(patientID)
+        if studies is None:
+            return None
+        selectedDICOM = []
+        for i, (studyUID, studyDescription, series) in enumerate(studies):
+            studyInfo = {}
+            studyInfo['displayName'] = studyDescription if studyDescription else "Study {0}".format(i)
+            studyInfo['id'] = studyUID
+            studyInfo['series'] = [
+                {'displayName': seriesDescription if seriesDescription else "Series {0}".format(j), 'id': seriesUID}
+                for j, (seriesUID, seriesDescription) in enumerate(series)]
+            selectedDICOM.append(studyInfo)
+        return selectedDICOM
+
+    def store(self, patientID, selectedDICOM):
+        """
+        Record studies fetched with per-patient queries so that later lookups are served locally.
+        """
+        with self._connect() as connection:
+            for study in selectedDICOM:
+                connection.execute("INSERT OR REPLACE INTO studies VALUES (?, ?, ?, ?, ?)",
+                    (self.serverURL, study['id'], patientID, "", study['displayName']))
+                connection.execute("DELETE FROM series WHERE server = ? AND study_uid = ?", (self.serverURL, study['id']))
+                connection.executemany("INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?)",
+                    [(self.serverURL, study['id'], serie['id'], None, serie['displayName']) for serie in study['series']])
+        with self._lock:
+            self._patientIndex[patientID] = [
+                (study['id'], study['displayName'], [(serie['id'], serie['displayName']) for serie in study['series']])
+                for study in selectedDICOM]
+
+    def startRefresh(self, dicomClient, full=False):
+        """
+        Sweep the server in a background thread. The first sweep, or a full one, covers all study dates
+        and replaces the index; later sweeps only re-query dates from the last sweep onward.
+        dicomClient is used by the sweep thread only.
+        """
+        if self.isBuilding:
+            return
+        self.isBuilding = True
+        self.lastError = None
+        self._thread = threading.Thread(target=self._refresh, args=(dicomClient, full), daemon=True)
+        self._thread.start()
+
+    def _refresh(self, dicomClient, full):
+        try:
+            today = datetime.date.today()
+            full = full or self._lastSweepDate is None
+            if full:
+                startDate = datetime.date(1900, 1, 1)
+            else:
+                # Studies can be added late on the day of the previous sweep, so overlap by one day.
+                startDate = datetime.datetime.strptime(self._lastSweepDate, '%Y%m%d').date() - datetime.timedelta(days=1)
+
+            studies = {}
+            for study in self._sweep(lambda dateRange, offset: dicomClient.search_for_studies(
+                    search_filters={'StudyDate': dateRange}, offset=offset, limit=self.pageSize), startDate, self.lastDate):
+                studyDS = pydicom.dataset.Dataset.from_json(study)
+                if getattr(studyDS, 'PatientID', None) is None:
+                    continue
+                studies[studyDS.StudyInstanceUID] = (studyDS.StudyInstanceUID, str(studyDS.PatientID),
+                    getattr(studyDS, 'StudyDate', ""), getattr(studyDS, 'StudyDescription', ""))
+
+            # Series are re-queried for every study of the swept window, since series can be added
+            # to a study that is already indexed.
+            try:
+                series = self._sweep(lambda dateRange, offset: dicomClient.search_for_series(
+                    search_filters={'StudyDate': dateRange}, fields=['StudyInstanceUID', 'SeriesNumber', 'SeriesDescription'],
+                    offset=offset, limit=self.pageSize), startDate, self.lastDate)
+                series = [pydicom.dataset.Dataset.from_json(serie) for serie in series]
+                if any(getattr(serieDS, 'StudyInstanceUID', None) is None for serieDS in series):
+                    raise ValueError('Series search results do not include StudyInstanceUID')
+            except Exception:
+                # Server does not support series searches at the root level, query series study by study
+                series = []
+                for studyUID in studies:
+                    for serie in self._pagedSearch(lambda offset: dicomClient.search_for_series(studyUID, offset=offset)):
+                        serieDS = pydicom.dataset.Dataset.from_json(serie)
+                        serieDS.StudyInstanceUID = studyUID
+                        series.append(serieDS)
+
+            seriesRows = {}
+            for serieDS in series:
+                if serieDS.StudyInstanceUID not in studies:
+                    continue
+                seriesRows[serieDS.SeriesInstanceUID] = (self.serverURL, serieDS.StudyInstanceUID, serieDS.SeriesInstanceUID,
+                    int(serieDS.SeriesNumber) if getattr(serieDS, 'SeriesNumber', None) not in (None, "") else None,
+                    getattr(serieDS, 'SeriesDescription', ""))
+
+            with self._connect() as connection:
+                if full:
+                    connection.execute("DELETE FROM studies WHERE server = ?", (self.serverURL,))
+                    connection.execute("DELETE FROM series WHERE server = ?", (self.serverURL,))
+                else:
+                    connection.executemany("DELETE FROM series WHERE server = ? AND study_uid = ?",
+                        [(self.serverURL, studyUID) for studyUID in studies])
+                connection.executemany("INSERT OR REPLACE INTO studies VALUES (?, ?, ?, ?, ?)",
+                    [(self.serverURL,) + study for study in studies.values()])
+                connection.executemany("INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?)", seriesRows.values())
+                connection.execute("INSERT OR REPLACE INTO sweeps VALUES (?, ?)", (self.serverURL, today.strftime('%Y%m%d')))
+            self._lastSweepDate = today.strftime('%Y%m%d')
+            self._loadPatientIndex()
+        except BaseException as e:
+            self.lastError = e
+        finally:
+            self.isBuilding = False
+
+    def _sweep(self, search, startDate, endDate):
+        """
+        Return the results of search(dateRange, offset) over all pages of the StudyDate window.
+        """
+        dateRange = '{0}-{1}'.format(startDate.strftime('%Y%m%d'), endDate.strftime('%Y%m%d'))
+        results = []
+        offset = 0
+        while True:
+            subset = search(dateRange, offset)
+            if len(subset) == 0:
+                break
+            if subset[0] in results:
+                # Server does not respect offset. A full page may be truncated, so split the date window instead.
+                if len(results) >= self.pageSize and startDate < endDate:
+                    middle = startDate + (endDate - startDate) // 2
+                    return (self._sweep(search, startDate, middle)
+                        + self._sweep(search, middle + datetime.timedelta(days=1), endDate))
+                break
+            results.extend(subset)
+            offset += len(subset)
+        return results
+
+    def _pagedSearch(self, search):
+        results = []
+        offset = 0
+        while True:
+            subset = search(offset)
+            if len(subset) == 0 or subset[0] in results:
+                break
+            results.extend(subset)
+            offset += len(subset)
+        return results
+
+    def _loadPatientIndex(self):
+        patientIndex = {}
+        with self._connect() as connection:
+            seriesByStudy = {}
+            for studyUID, seriesUID, description in connection.execute(
+                    "SELECT study_uid, series_uid, description FROM series WHERE server = ? ORDER BY series_number, rowid",
+                    (self.serverURL,)):
+                seriesByStudy.setdefault(studyUID, []).append((seriesUID, description))
+            for studyUID, patientID, description in connection.execute(
+                    "SELECT study_uid, patient_id, description FROM studies WHERE server = ? ORDER BY study_date, rowid",
+                    (self.serverURL,)):
+                patientIndex.setdefault(patientID, []).append((studyUID, description, seriesByStudy.get(studyUID, [])))
+        with self._lock:
+            self._patientIndex = patientIndex
@@ -0,0 +1,192 @@
+import concurrent.futures.process
+import os
+
+import numpy as np
+import pydicom
+
+# This module is imported by the worker processes of the parsing pool, so it must not import slicer, qt or vtk.
+
+# Attributes copied to the patient, study and series items of the subject hierarchy
+hierarchyKeywords = ('PatientName', 'PatientSex', 'PatientBirthDate', 'StudyDate', 'StudyTime', 'Modality', 'SeriesNumber')
+
+def ping():
+    """
+    Return the process ID of the worker, used to check that worker processes can be started.
+    """
+    return os.getpid()
+
+def hierarchyAttributes(ds):
+    """
+    Return the values of hierarchyKeywords found in the dataset, as strings.
+    """
+    return {keyword: str(ds.data_element(keyword).value) for keyword in hierarchyKeywords
+        if keyword in ds and ds.data_element(keyword).value not in (None, "")}
+
+def parseInstance(path):
+    """
+    Read a DICOM file and decode its pixel data. Runs in a worker process.
+    Returns the slice metadata and pixels, with pixels set to None if the file is not a single-frame
+    image slice that can be decoded here.
+    """
+    result = {'path': path, 'pixels': None}
+    try:
+        ds = pydicom.dcmread(path)
+        if 'PixelData' not in ds or 'ImagePositionPatient' not in ds or int(getattr(ds, 'NumberOfFrames', 1) or 1) != 1:
+            return result
+        result.update({
+            'sopInstanceUID': ds.SOPInstanceUID,
+            'photometricInterpretation': str(getattr(ds, 'PhotometricInterpretation', 'MONOCHROME2')),
+            'position': [float(value) for value in ds.ImagePositionPatient],
+            'orientation': [float(value) for value in ds.ImageOrientationPatient],
+            'spacing': [float(value) for value in ds.PixelSpacing],
+            'sliceThickness': float(getattr(ds, 'SliceThickness', 0) or 0),
+            'slope': float(getattr(ds, 'RescaleSlope', 1)),
+            'intercept': float(getattr(ds, 'RescaleIntercept', 0)),
+            'bitsStored': int(getattr(ds, 'BitsStored', ds.BitsAllocated)),
+            'patientID': str(getattr(ds, 'PatientID', "")),
+            'studyDescription': str(getattr(ds, 'StudyDescription', "")),
+            'seriesDescription': str(getattr(ds, 'SeriesDescription', "")),
+            'windowCenter': firstValue(ds, 'WindowCenter'),
+            'windowWidth': firstValue(ds, 'WindowWidth'),
+            'hierarchyAttributes': hierarchyAttributes(ds),
+            })
+        result['pixels'] = ds.pixel_array
+    except Exception as e:
+        result['pixels'] = None
+        result['error'] = str(e)
+    return result
+
+def firstValue(ds, keyword):
+    if keyword not in ds:
+        return None
+    value = ds.data_element(keyword).value
+    return float(value[0] if isinstance(value, pydicom.multival.MultiValue) else value)
+
+def sortFrames(positions, orientations):
+    """
+    Sort frames along the normal of their common orientation.
+    Returns (order, rowDirection, columnDirection, normal, sliceSpacing). Raises ValueError if the frames
+    do not form a single regular stack (different orientations, positions off the normal through the first
+    frame as in gantry-tilted acquisitions, repeated positions or uneven spacing).
+    """
+    positions = np.asarray(positions, dtype=float)
+    orientations = np.asarray(orientations, dtype=float)
+    if not np.allclose(orientations, orientations[0], atol=1e-3):
+        raise ValueError('Frames have different orientations')
+    rowDirection = orientations[0][:3]
+    columnDirection = orientations[0][3:]
+    normal = np.cross(rowDirection, columnDirection)
+
+    distances = positions @ normal
+    offsets = positions - positions[0] - np.outer(distances - distances[0], normal)
+    if np.max(np.linalg.norm(offsets, axis=1)) > 1e-2:
+        raise ValueError('Frames are not stacked along the normal of their orientation')
+    order = np.argsort(distances, kind='stable')
+    steps = np.diff(distances[order])
+    if len(steps) and np.min(steps) < 1e-3:
+        raise ValueError('Several frames share the same position')
+    sliceSpacing = float(np.median(steps)) if len(steps) else 1.0
+    if len(steps) and np.max(np.abs(steps - sliceSpacing)) > 0.01 * sliceSpacing + 1e-3:
+        raise ValueError('Frames are not evenly spaced')
+    return order, rowDirection, columnDirection, normal, sliceSpacing
+
+def rescaledDtype(storedDtype, bitsStored, slopes, intercepts):
+    """
+    Return the smallest voxel type that holds stored values after rescaling with the given slopes and intercepts.
+    """
+    slopes = np.asarray(slopes, dtype=float)
+    intercepts = np.asarray(intercepts, dtype=float)
+    if not (np.all(slopes == 1) and np.all(intercepts == intercepts[0]) and float(intercepts[0]).is_integer()):
+        return np.dtype(np.float32)
+    if intercepts[0] == 0:
+        return np.dtype(storedDtype).newbyteorder('=')
+    # Integer offset only (typical for CT): keep the smallest integer type holding the shifted range.
+    if np.dtype(storedDtype).kind == 'i':
+        low, high = -2 ** (bitsStored - 1), 2 ** (bitsStored - 1) - 1
+    else:
+        low, high = 0, 2 ** bitsStored - 1
+    fitsInt16 = np.iinfo(np.int16).min <= low + intercepts[0] and high + intercepts[0] <= np.iinfo(np.int16).max
+    return np.dtype(np.int16 if fitsInt16 else np.int32)
+
+def assembleVolume(slices):
+    """
+    Stack parsed slices into a volume array ordered along the slice normal and apply rescaling.
+    Returns (voxels, geometry) where geometry holds origin, directions, spacings and the SOP instance UIDs
+    in slice order. Raises ValueError if
+    the slices cannot be loaded as a single scalar volume.
+    """
+    if len(slices) == 0:
+        raise ValueError('Series has no instances')
+    for instance in slices:
+        if instance['pixels'] is None:
+            raise ValueError('{0} is not a decodable single-frame image slice{1}'.format(
+                instance['path'], ': ' + instance['error'] if 'error' in instance else ''))
+        if instance['photometricInterpretation'] != 'MONOCHROME2':
+            raise ValueError('{0} has photometric interpretation {1}'.format(instance['path'], instance['photometricInterpretation']))
+    shapes = set(instance['pixels'].shape for instance in slices)
+    if len(shapes) != 1 or len(next(iter(shapes))) != 2:
+        raise ValueError('Slices are not single-channel images of the same size')
+
+    order, rowDirection, columnDirection, normal, sliceSpacing = sortFrames(
+        [instance['position'] for instance in slices], [instance['orientation'] for instance in slices])
+    slices = [slices[index] for index in order]
+    if len(slices) == 1 and slices[0]['sliceThickness'] > 0:
+        sliceSpacing = slices[0]['sliceThickness']
+
+    stored = np.stack([instance['pixels'] for instance in slices])
+    slopes = np.array([instance['slope'] for instance in slices])
+    intercepts = np.array([instance['intercept'] for instance in slices])
+    dtype = rescaledDtype(stored.dtype, slices[0]['bitsStored'], slopes, intercepts)
+    if dtype.kind == 'f':
+        voxels = (stored * slopes[:, None, None] + intercepts[:, None, None]).astype(dtype)
+    else:
+        voxels = stored.astype(dtype) + dtype.type(intercepts[0])
+
+    geometry = {
+        'origin': np.array(slices[0]['position']),
+        'rowDirection': rowDirection,
+        'columnDirection': columnDirection,
+        'normal': normal,
+        'pixelSpacing': np.array(slices[0]['spacing']),
+        'sliceSpacing': sliceSpacing,
+        'instanceUIDs': [instance['sopInstanceUID'] for instance in slices],
+        }
+    return voxels, geometry
+
+class SeriesParser:
+    """
+    Parses instances of a series in an executor as they are written, so that parsing and pixel decoding
+    overlap with the download of the remaining instances.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.broken = False
+        self._paths = []
+        self._futures = []
+
+    def submit(self, path):
+        self._paths.append(path)
+        future = None
+        if not self.broken:
+            try:
+                future = self.executor.submit(parseInstance, path)
+            except concurrent.futures.process.BrokenProcessPool:
+                self.broken = True
+        self._futures.append(future)
+
+    def results(self):
+        """
+        Wait for all submitted instances and return their parsed slices in submission order.
+        """
+        results = []
+        for path, future in zip(self._paths, self._futures):
+            try:
+                if future is not None:
+                    results.append(future.result())
+                    continue
+            except concurrent.futures.process.BrokenProcessPool:
+                self.broken = True
+            # Worker processes could not be started or died, parse in this process instead
+            results.append(parseInstance(path))
+        return results
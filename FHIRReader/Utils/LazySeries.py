@@ -0,0 +1,331 @@
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+import pydicom
+import qt
+import slicer
+import vtk
+
+from Utils import DICOMPipeline
+
+def ijkToRASMatrix(origin, rowDirection, columnDirection, pixelSpacing, sliceSpacing):
+    """
+    Return the IJK to RAS matrix of a stack of slices from their DICOM (LPS) geometry.
+    """
+    ijkToLPS = vtk.vtkMatrix4x4()
+    # PixelSpacing is (row spacing, column spacing): i runs along a row, j along a column.
+    normal = np.cross(rowDirection, columnDirection)
+    axes = (rowDirection * pixelSpacing[1], columnDirection * pixelSpacing[0], normal * sliceSpacing)
+    for row in range(3):
+        for column in range(3):
+            ijkToLPS.SetElement(row, column, axes[column][row])
+        ijkToLPS.SetElement(row, 3, origin[row])
+    lpsToRAS = vtk.vtkMatrix4x4()
+    lpsToRAS.SetElement(0, 0, -1)
+    lpsToRAS.SetElement(1, 1, -1)
+    ijkToRAS = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Multiply4x4(lpsToRAS, ijkToLPS, ijkToRAS)
+    return ijkToRAS
+
+def applyWindowLevel(volumeNode, windowCenter, windowWidth):
+    """
+    Create the display node of a volume, using the DICOM window if there is one.
+    """
+    volumeNode.CreateDefaultDisplayNodes()
+    if windowCenter is not None and windowWidth is not None:
+        displayNode = volumeNode.GetDisplayNode()
+        displayNode.AutoWindowLevelOff()
+        displayNode.SetWindowLevel(float(windowWidth), float(windowCenter))
+
+class LazySeriesVolume:
+    """
+    Scalar volume whose slices are retrieved on demand with WADO-RS frame requests.
+
+    The geometry is built from the series metadata alone. Frames closest to the slice
+    currently shown in any slice view are retrieved first; when fillInBackground is set
+    the remaining frames are then retrieved outward from that position.
+
+    createClient is called to get a DICOMwebClient for each retrieving thread.
+    """
+
+    # Frames are requested as uncompressed bytes, so only series stored uncompressed are retrieved lazily
+    uncompressedTransferSyntaxes = (pydicom.uid.ImplicitVRLittleEndian, pydicom.uid.ExplicitVRLittleEndian)
+
+    # Failed frames are retried after retryDelay seconds, doubled on each attempt. After maxAttempts
+    # the frame is left blank and counted as done so that the volume can complete.
+    maxAttempts = 4
+    retryDelay = 1.0
+
+    def __init__(self, createClient, studyUID, seriesUID, metadata, workerCount=4, readAhead=8, fillInBackground=True):
+        self.createClient = createClient
+        self.studyUID = studyUID
+        self.seriesUID = seriesUID
+        self.workerCount = workerCount
+        self.readAhead = readAhead
+        self.fillInBackground = fillInBackground
+        self.volumeNode = None
+
+        self._frames = []
+        self._parseMetadata(metadata)
+
+        self._lock = threading.Lock()
+        self._requested = np.zeros(len(self._frames), dtype=bool)
+        self._fetched = np.zeros(len(self._frames), dtype=bool)
+        self._attempts = np.zeros(len(self._frames), dtype=int)
+        self._retryTime = np.zeros(len(self._frames))
+        self.failedFrameCount = 0
+        self._cursor = len(self._frames) // 2
+        self._results = queue.Queue()
+        self._wakeUp = threading.Condition(self._lock)
+        self._stopped = False
+        self._threads = []
+        self._sliceObservations = []
+        self._timer = None
+
+    @property
+    def frameCount(self):
+        return len(self._frames)
+
+    @staticmethod
+    def countFrames(metadata):
+        return sum(int(instance['00280008']['Value'][0]) if '00280008' in instance else 1 for instance in metadata)
+
+    def _parseMetadata(self, metadata):
+        """
+        Collect per-frame geometry from instance metadata. Raises ValueError if the frames
+        do not form a single regular stack (for example several temporal positions).
+        """
+        first = None
+        for instance in metadata:
+            # Pixel data is only referenced by BulkDataURI in metadata responses, leave it out.
+            ds = pydicom.dataset.Dataset.from_json({tag: value for tag, value in instance.items() if tag != '7FE00010'})
+            if first is None:
+                first = ds
+            self._checkPixelFormat(ds)
+            numberOfFrames = int(getattr(ds, 'NumberOfFrames', 1) or 1)
+            shared = ds.SharedFunctionalGroupsSequence[0] if 'SharedFunctionalGroupsSequence' in ds else None
+            for frameIndex in range(numberOfFrames):
+                if 'PerFrameFunctionalGroupsSequence' in ds:
+                    perFrame = ds.PerFrameFunctionalGroupsSequence[frameIndex]
+                    position = perFrame.PlanePositionSequence[0].ImagePositionPatient
+                    orientation = self._functionalGroupValue(perFrame, shared, 'PlaneOrientationSequence', 'ImageOrientationPatient')
+                    spacing = self._functionalGroupValue(perFrame, shared, 'PixelMeasuresSequence', 'PixelSpacing')
+                    slope = self._functionalGroupValue(perFrame, shared, 'PixelValueTransformationSequence', 'RescaleSlope', 1)
+                    intercept = self._functionalGroupValue(perFrame, shared, 'PixelValueTransformationSequence', 'RescaleIntercept', 0)
+                else:
+                    position = ds.ImagePositionPatient
+                    orientation = ds.ImageOrientationPatient
+                    spacing = ds.PixelSpacing
+                    slope = getattr(ds, 'RescaleSlope', 1)
+                    intercept = getattr(ds, 'RescaleIntercept', 0)
+                self._frames.append({
+                    'sopInstanceUID': ds.SOPInstanceUID,
+                    'frameNumber': frameIndex + 1,
+                    'position': np.array(position, dtype=float),
+                    'orientation': np.array(orientation, dtype=float),
+                    'spacing': np.array(spacing, dtype=float),
+                    'slope': float(slope),
+                    'intercept': float(intercept),
+                    })
+
+        if first is None:
+            raise ValueError('Series has no instances')
+
+        self.rows = int(first.Rows)
+        self.columns = int(first.Columns)
+        self.studyDescription = getattr(first, 'StudyDescription', "")
+        self.seriesDescription = getattr(first, 'SeriesDescription', "")
+        self.patientID = str(getattr(first, 'PatientID', ""))
+        self.hierarchyAttributes = DICOMPipeline.hierarchyAttributes(first)
+        self.windowCenter = DICOMPipeline.firstValue(first, 'WindowCenter')
+        self.windowWidth = DICOMPipeline.firstValue(first, 'WindowWidth')
+        self._storedDtype = np.dtype('{0}{1}'.format(
+            'i' if int(getattr(first, 'PixelRepresentation', 0)) else 'u', int(first.BitsAllocated) // 8)).newbyteorder('<')
+
+        order, self.rowDirection, self.columnDirection, self.normal, self.sliceSpacing = DICOMPipeline.sortFrames(
+            [frame['position'] for frame in self._frames], [frame['orientation'] for frame in self._frames])
+        self._frames = [self._frames[index] for index in order]
+        self.instanceUIDs = list(dict.fromkeys(frame['sopInstanceUID'] for frame in self._frames))
+
+        self._dtype = DICOMPipeline.rescaledDtype(self._storedDtype, int(getattr(first, 'BitsStored', first.BitsAllocated)),
+            [frame['slope'] for frame in self._frames], [frame['intercept'] for frame in self._frames])
+
+    def _checkPixelFormat(self, ds):
+        """
+        Raise ValueError unless frames of the instance can be decoded from raw bytes into a grayscale slice.
+        """
+        if int(getattr(ds, 'SamplesPerPixel', 1)) != 1:
+            raise ValueError('Instance {0} is not a single-channel image'.format(ds.SOPInstanceUID))
+        if getattr(ds, 'PhotometricInterpretation', 'MONOCHROME2') != 'MONOCHROME2':
+            raise ValueError('Instance {0} has photometric interpretation {1}'.format(ds.SOPInstanceUID, ds.PhotometricInterpretation))
+        if int(ds.BitsAllocated) not in (8, 16, 32):
+            raise ValueError('Instance {0} has {1} bits allocated'.format(ds.SOPInstanceUID, ds.BitsAllocated))
+        transferSyntax = getattr(ds, 'TransferSyntaxUID', None)
+        if transferSyntax is not None and transferSyntax not in self.uncompressedTransferSyntaxes:
+            raise ValueError('Instance {0} is stored with transfer syntax {1}'.format(ds.SOPInstanceUID, transferSyntax))
+
+    @staticmethod
+    def _functionalGroupValue(perFrame, shared, sequenceName, attributeName, default=None):
+        for group in (perFrame, shared):
+            if group is not None and sequenceName in group and attributeName in group[sequenceName].value[0]:
+                return getattr(group[sequenceName].value[0], attributeName)
+        if default is None:
+            raise ValueError('Missing {0} in functional groups'.format(attributeName))
+        return default
+
+    def createVolumeNode(self, name=None):
+        """
+        Create an empty volume node with the series geometry and start retrieving frames.
+        """
+        self.volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', name or self.seriesDescription or self.seriesUID)
+        self.volumeNode.SetIJKToRASMatrix(ijkToRASMatrix(self._frames[0]['position'], self.rowDirection, self.columnDirection,
+            self._frames[0]['spacing'], self.sliceSpacing))
+        slicer.util.updateVolumeFromArray(self.volumeNode, np.zeros((len(self._frames), self.rows, self.columns), dtype=self._dtype))
+        applyWindowLevel(self.volumeNode, self.windowCenter, self.windowWidth)
+
+        self._rasToIJK = vtk.vtkMatrix4x4()
+        self.volumeNode.GetRASToIJKMatrix(self._rasToIJK)
+
+        for sliceNode in slicer.util.getNodesByClass('vtkMRMLSliceNode'):
+            tag = sliceNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onSliceNodeModified)
+            self._sliceObservations.append((sliceNode, tag))
+
+        self._timer = qt.QTimer()
+        self._timer.setInterval(100)
+        self._timer.connect('timeout()', self.onTimer)
+        self._timer.start()
+
+        for _ in range(self.workerCount):
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self.volumeNode
+
+    def probe(self):
+        """
+        Retrieve the frame at the cursor, raising an exception if it cannot be retrieved as raw pixels.
+        Called before the volume is created so that failing servers fall back to complete instances.
+        """
+        index = self._cursor
+        pixels = self._retrieveFrame(self.createClient(), index)
+        with self._lock:
+            self._requested[index] = True
+        self._results.put((index, pixels))
+
+    def _retrieveFrame(self, dicomClient, index):
+        frame = self._frames[index]
+        frameData = dicomClient.retrieve_instance_frames(
+            study_instance_uid=self.studyUID,
+            series_instance_uid=self.seriesUID,
+            sop_instance_uid=frame['sopInstanceUID'],
+            frame_numbers=[frame['frameNumber']],
+            media_types=('application/octet-stream',))[0]
+        if len(frameData) < self.rows * self.columns * self._storedDtype.itemsize:
+            raise ValueError('Frame {0} of instance {1} has {2} bytes, expected {3}'.format(frame['frameNumber'],
+                frame['sopInstanceUID'], len(frameData), self.rows * self.columns * self._storedDtype.itemsize))
+        pixels = np.frombuffer(frameData, dtype=self._storedDtype, count=self.rows * self.columns)
+        pixels = pixels.reshape(self.rows, self.columns) * frame['slope'] + frame['intercept']
+        return pixels.astype(self._dtype)
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            self._wakeUp.notify_all()
+        for sliceNode, tag in self._sliceObservations:
+            sliceNode.RemoveObserver(tag)
+        self._sliceObservations = []
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+
+    @property
+    def isComplete(self):
+        """
+        True when every frame was retrieved or given up on (see failedFrameCount).
+        """
+        return bool(np.all(self._fetched))
+
+    def onSliceNodeModified(self, sliceNode, event):
+        sliceToRAS = sliceNode.GetSliceToRAS()
+        center = [sliceToRAS.GetElement(0, 3), sliceToRAS.GetElement(1, 3), sliceToRAS.GetElement(2, 3), 1]
+        k = int(round(self._rasToIJK.MultiplyPoint(center)[2]))
+        if k < 0 or k >= len(self._frames):
+            return
+        with self._lock:
+            if k != self._cursor:
+                self._cursor = k
+                self._wakeUp.notify_all()
+
+    def _nextFrameIndex(self):
+        """
+        Return the unrequested frame closest to the cursor, or None if there is nothing to do.
+        Frames waiting for a retry are skipped until their retry time. Must be called with the lock held.
+        """
+        now = time.monotonic()
+        radius = len(self._frames) if self.fillInBackground else self.readAhead
+        for offset in range(radius + 1):
+            for index in (self._cursor + offset, self._cursor - offset):
+                if 0 <= index < len(self._frames) and not self._requested[index] and self._retryTime[index] <= now:
+                    return index
+        return None
+
+    def _retryWaitTime(self):
+        """
+        Return the time until the next frame can be retried, or None if no frame is waiting for a retry.
+        Must be called with the lock held.
+        """
+        waiting = self._retryTime[~self._requested]
+        waiting = waiting[waiting > 0]
+        if len(waiting) == 0:
+            return None
+        return max(float(np.min(waiting)) - time.monotonic(), 0.0)
+
+    def _worker(self):
+        dicomClient = self.createClient()
+        while True:
+            with self._lock:
+                index = self._nextFrameIndex()
+                while index is None and not self._stopped:
+                    if np.all(self._requested):
+                        return
+                    self._wakeUp.wait(self._retryWaitTime())
+                    index = self._nextFrameIndex()
+                if self._stopped:
+                    return
+                self._requested[index] = True
+            try:
+                self._results.put((index, self._retrieveFrame(dicomClient, index)))
+            except BaseException as e:
+                frame = self._frames[index]
+                with self._lock:
+                    self._attempts[index] += 1
+                    if self._attempts[index] >= self.maxAttempts:
+                        logging.warning('Giving up on frame {0} of instance {1} after {2} attempts: {3}'.format(
+                            frame['frameNumber'], frame['sopInstanceUID'], self._attempts[index], e))
+                        self.failedFrameCount += 1
+                        self._results.put((index, None))
+                    else:
+                        logging.info('Error retrieving frame {0} of instance {1}, retrying: {2}'.format(
+                            frame['frameNumber'], frame['sopInstanceUID'], e))
+                        self._retryTime[index] = time.monotonic() + self.retryDelay * 2 ** (self._attempts[index] - 1)
+                        self._requested[index] = False
+
+    def onTimer(self):
+        if self.volumeNode is None or self.volumeNode.GetScene() is None:
+            # Volume was removed from the scene, no need to keep retrieving frames.
+            self.stop()
+            return
+        if self._results.empty():
+            return
+        array = slicer.util.arrayFromVolume(self.volumeNode)
+        while not self._results.empty():
+            index, pixels = self._results.get()
+            if pixels is not None:
+                array[index] = pixels
+            self._fetched[index] = True
+        slicer.util.arrayFromVolumeModified(self.volumeNode)
+        if self.isComplete:
+            self.stop()